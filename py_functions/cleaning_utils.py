@@ -5,10 +5,17 @@ Created on Wed Oct 25 21:55:23 2023
 @author: Arvin Jay
 """
 
+import warnings
+from contextlib import nullcontext
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 import dateparser
 from jellyfish import soundex
-from fuzzywuzzy import fuzz
+from rapidfuzz.fuzz import ratio as _ratio
+from rapidfuzz.process import cdist, cpdist
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 
 hard_coded_dict = {
         'traffic':'transit',
@@ -36,35 +43,58 @@ def generate_url(csv_link):
     return f'https://drive.google.com/uc?id={source_id}'
 
 
-def custom_parser(unparsed_timestamp):
+@lru_cache(maxsize=4096)
+def parse_fallback(unparsed_timestamp):
     """
-    Customized timestamp parser to handle various timestamp formats.
+    Parse a single timestamp that pd.to_datetime could not handle. Results
+    are memoized since dateparser is slow and odd formats tend to repeat.
 
     Parameters:
     unparsed_timestamp (str): The unparsed timestamp.
-        pd.to_datetime(unparsed_timestamp) handles the more common datetime formats
-        dateparser.parse(unparsed_timestamp) handles the russian datetime formats
-        
+
     Returns:
-    pd.Timestamp: The parsed timestamp.
+    datetime or pd.NaT: The parsed timestamp.
     
-    >>> custom_parser('2019-09-27 00:00:00 UTC')
-    '2019-09-27 00:00:00 UTC'
-    >>> custom_parser('26 сентября 2019 00:00')
-    '2019-09-26 00:00:00 UTC'
+    >>> parse_fallback('26 сентября 2019 00:00')
+    datetime.datetime(2019, 9, 26, 0, 0)
     """
     try:
-        return pd.to_datetime(unparsed_timestamp).tz_localize(None)
-    except ValueError:
-        try:
-            return dateparser.parse(unparsed_timestamp)
-        except ValueError:
-            return pd.NaT
+        return dateparser.parse(unparsed_timestamp) or pd.NaT
+    except (TypeError, ValueError):
+        return pd.NaT
+
+
+def custom_parser(unparsed_timestamps):
+    """
+    Customized timestamp parser to handle various timestamp formats.
+
+    Parameters:
+    unparsed_timestamps (pd.Series): The unparsed timestamps.
+        pd.to_datetime(unparsed_timestamps) handles the more common datetime
+        formats in one vectorized pass
+        parse_fallback handles the rows left unparsed, ie the russian
+        datetime formats
+        
+    Returns:
+    pd.Series: The parsed, naive timestamps.
+    
+    >>> custom_parser(pd.Series(['2019-09-27 00:00:00 UTC',
+    ...                          '26 сентября 2019 00:00'])).tolist()
+    [Timestamp('2019-09-27 00:00:00'), Timestamp('2019-09-26 00:00:00')]
+    """
+    parsed = pd.to_datetime(unparsed_timestamps, utc=True, errors='coerce')
+    mask = parsed.isna() & unparsed_timestamps.notna()
+    if mask.any():
+        parsed.loc[mask] = pd.to_datetime(
+            unparsed_timestamps.loc[mask].map(parse_fallback),
+            utc=True, errors='coerce')
+    return parsed.dt.tz_localize(None)
 
 
 def load_csv(url): # add try except
     """
-    Load data from a CSV file and parse timestamps.
+    Load data from a CSV file and parse timestamps. The multi-threaded
+    pyarrow engine is used when pyarrow is installed.
     
     Parameters:
     url (str): The URL of the CSV file.
@@ -76,7 +106,36 @@ def load_csv(url): # add try except
     pd.DataFrame of data from Google Drive where the column 'timestamp' has
     been parsed using custom parser
     """
-    return pd.read_csv(url, parse_dates=['timestamp'], date_parser=custom_parser)
+    try:
+        df = pd.read_csv(url, engine='pyarrow')
+    except ImportError:
+        df = pd.read_csv(url)
+    df['timestamp'] = custom_parser(df['timestamp'])
+    return df
+
+
+def copy_on_write():
+    """
+    Context manager enabling pandas' copy-on-write mode so filtered frames
+    can be assigned into without defensive copies. It is a no-op where the
+    mode is already always on (pandas >= 3) or not available (pandas < 1.5).
+
+    Returns:
+    contextlib.AbstractContextManager: The context enabling copy-on-write.
+    
+    >>> with copy_on_write():
+    ...     df = clean_df(df,correction_dict)
+    """
+    try:
+        with warnings.catch_warnings():
+            # the option is deprecated from pandas 3 where it is always True
+            warnings.simplefilter('ignore', DeprecationWarning)
+            enabled = pd.get_option('mode.copy_on_write')
+    except KeyError:
+        return nullcontext()
+    if enabled is True:
+        return nullcontext()
+    return pd.option_context('mode.copy_on_write', True)
 
 
 def clean_df(df,correction_dict):
@@ -93,39 +152,27 @@ def clean_df(df,correction_dict):
             null values in 'user' are dropped
             considered number of checkin hours is >0
             correction_dict is applied to 'project' column
+            'timestamp' is normalized to UTC and made naive
         
     >>> clean_df(df,correction_dict)
     pd.DataFrame of cleaned data that has been loaded. The column 'project'
     has been corrected for fuzzymatched and phonetically matching terms
     """
-    df = df[df['user'].notnull()]#df.fillna('Unknown')
-    df = df[df['hours']>0]
-    df['project']=df['project'].apply(lambda x: apply_correction(correction_dict,x))
-    df['timestamp'] = df['timestamp'].apply(lambda x: make_naive(x))
+    mask = df['user'].notna().to_numpy() & (df['hours'].to_numpy()>0)#df.fillna('Unknown')
+    with copy_on_write():
+        df = df.loc[mask]
+        df['project']=df['project'].map(correction_dict).fillna(df['project'])
+        # load_csv already returns naive UTC timestamps, other inputs are
+        # parsed here
+        if not pd.api.types.is_datetime64_dtype(df['timestamp']):
+            df['timestamp'] = custom_parser(df['timestamp'])
     return df
     
 
-def calculate_similarity(entry1, entry2):
-    """
-    Calculate the similarity between two strings using the fuzz.ratio method.
-
-    Parameters:
-    entry1 (str): The first string.
-    entry2 (str): The second string.
-
-    Returns:
-    int: The similarity score.
-    
-    >>> calculate_similarity('project-30', 'project-31')
-    90
-    """
-    return fuzz.ratio(entry1, entry2)
-
-
 def construct_projects_df(df):
     """
-    Construct a DataFrame of project names and their counts, soundex values, 
-    shifted project names, along with similarity scores.
+    Construct a DataFrame of project names and their counts along with their
+    soundex values.
 
     Parameters:
     df (pd.DataFrame): The input loaded DataFrame.
@@ -136,37 +183,37 @@ def construct_projects_df(df):
     >>> construct_projects_df(df)
     # Projects DataFrame
     """
-    projects_df = df.project.value_counts()
-    projects_df = projects_df.reset_index()
-    projects_df = projects_df.rename(columns = {'project':'index','count':'project'})
-    projects_df['soundex'] = projects_df['index'].map(soundex)
+    value_counts = df['project'].value_counts() # missing projects are dropped
+    names = value_counts.index.to_numpy()
+    projects_df = pd.DataFrame({'index':names,
+                                'project':value_counts.to_numpy(np.int32)})
+    projects_df['soundex'] = np.array([soundex(name) for name in names],
+                                      dtype=object)
     projects_df = projects_df.sort_values(by=['soundex','project'])
-    
-    projects_df['shifted'] = projects_df['index'].shift(1)
-    projects_df['similarity_score'] = projects_df.apply(lambda row: calculate_similarity(row['index'], row['shifted']), axis=1)
     return projects_df
         
 
-def process_group(df_temp, correction_dict):
+def process_group(cluster, counts, correction_dict):
     """
     Process a group of similar project names and update the correction 
-    dictionary for similar terms in the 'project' column.
+    dictionary for similar terms in the 'project' column. The most frequent
+    name in the group is used as the correction.
 
     Parameters:
-    df_temp (list): A list of project names with similarity.
+    cluster (np.ndarray): A cluster of similar project names.
+    counts (dict): The count of every project name.
     correction_dict (dict): The correction dictionary for project names.
 
     Returns:
     dict: Updated correction dictionary.
     
-    >>> process_group(sample_group, sample_correction_dict)
-    # Updated correction dictionary
+    >>> process_group(np.array(['hirng','hiring'], dtype=object),
+    ...               {'hirng':1,'hiring':2}, {})
+    {'hirng': 'hiring', 'hiring': 'hiring'}
     """    
-    df_temp = pd.DataFrame(df_temp)
-    df_temp = df_temp.sort_values(by='project', ascending=False)
-    elements = list(set(df_temp['index'].tolist()+df_temp['shifted'].tolist()))
-    for entry in elements:
-        correction_dict[entry] = df_temp['index'].iloc[0]
+    rep = max(cluster, key=counts.get)
+    for entry in cluster:
+        correction_dict[entry] = rep
     return correction_dict
 
 
@@ -177,11 +224,13 @@ def generate_correction_dict(df):
     df : pandas DataFrame
         
         The default is projects_df-  which contains columns 
-        for the index (project name), project (count),
-        shifted (shifted project name), and similarity_score (fuzzywuzzy 
-        similarity score). This function iterates over the rows of df to create 
-        a correction dictionary. The criteria for the correction is having a 
-        similar soundex score and a similarity score of greater than 90.
+        for the index (project name), project (count) and soundex, sorted
+        by soundex. This function scores every pair of names sharing a
+        soundex value with rapidfuzz, as well as the neighbouring names on
+        either side of a soundex boundary, and clusters the names connected
+        by a similarity score of greater than 90, directly or through other
+        names, to create a correction dictionary. The most frequent name
+        of each cluster is used as the correction.
 
     Returns
     -------
@@ -209,67 +258,51 @@ def generate_correction_dict(df):
                       "opdandadmin": "opsandadmin"
                     }
     """
-    df_temp = list()
     correction_dict = dict()
-    for index, row in df.iterrows():
-        if row['similarity_score'] > 90:
-            df_temp.append(row)
-        elif len(df_temp)> 0:
-            correction_dict = process_group(df_temp, correction_dict)
-            df_temp = list()
-        else:
-            pass
-    if df_temp:
-        correction_dict = process_group(df_temp, correction_dict)
+    names = df['index'].to_numpy()
+    counts = dict(zip(names, df['project'].to_numpy()))
+    rows = [np.empty(0, dtype=np.intp)]
+    cols = [np.empty(0, dtype=np.intp)]
+    # every pair of names in the same soundex bucket is compared
+    for positions in df.groupby('soundex', sort=False).indices.values():
+        if len(positions) < 2:
+            continue
+        bucket = names[positions]
+        # a worker pool only pays off for large buckets
+        scores = cdist(bucket, bucket, scorer=_ratio, score_cutoff=90,
+                       dtype=np.uint8,
+                       workers=-1 if len(positions) > 64 else 1)
+        i, j = np.nonzero(scores > 90)
+        rows.append(positions[i])
+        cols.append(positions[j])
+    # as well as the neighbouring names across each soundex boundary
+    sx = df['soundex'].to_numpy()
+    boundary = np.flatnonzero(sx[1:] != sx[:-1]) + 1
+    scores = cpdist(names[boundary - 1], names[boundary], scorer=_ratio,
+                    score_cutoff=90, dtype=np.uint8,
+                    workers=-1 if len(boundary) > 64 else 1)
+    linked = boundary[scores > 90]
+    rows.append(linked - 1)
+    cols.append(linked)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    graph = csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                       shape=(len(names), len(names)))
+    _, labels = connected_components(graph, directed=False)
+    order = np.argsort(labels, kind='stable')
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    for cluster in np.split(order, bounds):
+        if len(cluster) > 1:
+            correction_dict = process_group(names[cluster], counts,
+                                            correction_dict)
     return correction_dict
         
 
-def make_naive(x):
-    """
-    Convert a datetime series to a naive datetime series.
-
-    Parameters:
-    x : datetime object that may or may not be timezone aware
-
-    Returns:
-    x : naive datetime object
-
-    >>> make_naive(pd.Series(['2023-10-25 12:00:00']))
-    Timestamp('2023-10-25 12:00:00')
-    """
-    try:
-        x = pd.to_datetime(x).dt.tz_convert(None)
-    except:
-        pass
-    return x
-
-
-def apply_correction(correction_dict, value):
-    """
-    Apply corrections to a project name using the correction dictionary.
-
-    Parameters:
-    correction_dict (dict): The correction dictionary for project names.
-    value (str): The project name to be corrected.
-
-    Returns:
-    str: The corrected project name.
-    
-    >>> apply_correction(correction_dict, 'opdandadmin')
-    'opsandadmin'
-    """
-    try:
-        value = correction_dict[value]
-    except KeyError:
-        pass
-    return value
-
-
 def cleaning_process(hard_coded_link):
     """
     Perform the data cleaning process, including loading data, 
     constructing a correction dictionary, and cleaning the DataFrame,
-    essentially the main algorithm for the cleaning of the raw data
+    essentially the main algorithm for the cleaning of the raw data.
 
     Parameters:
     hard_coded_link (str): The hard-coded link to the data source.
@@ -4,29 +4,46 @@ Created on Thu Oct 26 22:54:12 2023
 
 @author: Arvin Jay
 """
-import time,json
+import json
+from functools import lru_cache
 from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
 from google.oauth2 import service_account
 import pandas as pd
 
 
-def authenticate_bq(acct):
+@lru_cache(maxsize=4)
+def _client_for(acct_json):
     """
-    Authenticate to Google BigQuery personal trial service account.
+    Build the BigQuery client and credentials for a service account, cached
+    so repeated calls reuse one client and its connection.
 
     Parameters:
-    acct (dict): secrets.json file from generated key
+    acct_json (str): The service account info serialized with sorted keys.
 
     Returns:
     tuple: A tuple containing the BigQuery client and credentials.
     """
     credentials = service_account.Credentials.from_service_account_info(
-        acct
+        json.loads(acct_json)
     )
     client = bigquery.Client(credentials=credentials,project=credentials.project_id)
     return client,credentials
 
 
+def authenticate_bq(acct):
+    """
+    Authenticate to Google BigQuery personal trial service account.
+
+    Parameters:
+    acct (dict): secrets.json file from generated key
+
+    Returns:
+    tuple: A tuple containing the BigQuery client and credentials.
+    """
+    return _client_for(json.dumps(dict(acct), sort_keys=True))
+
+
 def check_dataset(client,project_id,dataset_name):
     """
     Create a bigquery dataset if it does not exist.
@@ -39,26 +56,23 @@ def check_dataset(client,project_id,dataset_name):
     Returns:
     None but status is printed in console 
     """
-    datasets = [i.dataset_id for i in list(client.list_datasets())]
-    if dataset_name not in datasets:
-        platform_dataset = f"{project_id}.{dataset_name}" #format "project_id.platform" ie "lica-rdbms.rapide"
+    platform_dataset = f"{project_id}.{dataset_name}" #format "project_id.platform" ie "lica-rdbms.rapide"
+    try:
+        client.get_dataset(platform_dataset)
+        print("{} already in GCP-Bigquery".format(dataset_name.title()))
+    except NotFound:
         dataset = bigquery.Dataset(platform_dataset)
         dataset.location = "US"
         dataset = client.create_dataset(dataset, timeout=30)
         print("Created dataset {}".format(platform_dataset))
-        datasets = [i.dataset_id for i in list(client.list_datasets())]
-        print("Updated GCP-Bigquery datasets")
-        print(datasets)
-    else:
-        print("{} already in GCP-Bigquery".format(dataset_name.title()))
-        pass
 
 
 def bq_write(df,credentials,dataset_name,table_name,client,date_field='timestamp'):
     """
     Write a pandas DataFrame to a BigQuery table and is partitioned based on
     the date_field column per DAY. This saves us costs when we are dealing
-    with a load of data.
+    with a load of data. The DataFrame is shipped as Parquet so the column
+    types are kept instead of being autodetected from CSV.
 
     Parameters:
     df (pd.DataFrame): The DataFrame to write.
@@ -81,8 +95,8 @@ def bq_write(df,credentials,dataset_name,table_name,client,date_field='timestamp
     
     job_config = bigquery.LoadJobConfig(
                 write_disposition = 'WRITE_TRUNCATE',
-                source_format=bigquery.SourceFormat.CSV,
-                autodetect=True,
+                source_format=bigquery.SourceFormat.PARQUET,
+                schema=[bigquery.SchemaField(date_field,'TIMESTAMP')],
                 time_partitioning=bigquery.TimePartitioning(
                         type_=bigquery.TimePartitioningType.DAY,
                         field=date_field
@@ -93,9 +107,6 @@ def bq_write(df,credentials,dataset_name,table_name,client,date_field='timestamp
                 df, 
                 target_table_id,
                 job_config=job_config)
-    while job.state != "DONE":
-        time.sleep(2)
-        job.reload()
     print(job.result())
     table =client.get_table(target_table_id)
     if table.num_rows==len(df):